@@ -2,77 +2,179 @@ import cv2
 import numpy as np
 import HandTrackingModule as htm
 import time
+import threading
+from collections import deque
 import pyautogui
 
 ############################
 wCam, hCam = 640, 480
 frameR = 100  # frame reduction
 smoothening = 10
+clickDelay = 0.2  # seconds between clicks
+fpsRefresh = 10  # frames between FPS text updates
+idleAfter = 30  # frames without a hand before slowing down
+idleWait = 50  # ms to wait per frame while idle
 ############################
 
-pTime = 0
-plocX, plocY = 0, 0
-clocX, clocy = 0, 0
-
-cap = cv2.VideoCapture(0)
-cap.set(3, wCam)
-cap.set(4, hCam)
-detector = htm.handDetector()
-wScr, hScr = 1920.0, 1080.0
-
-while True:
-    # 1. Find hand Landmarks
-    success, img = cap.read()
-    img = detector.findHands(img)
-    lmList, bbox = detector.findPosition(img)
-
-    # 2. Find the tips of the index and middle fingers
-    if len(lmList) != 0:
-        x1, y1 = lmList[8][1:]
-        x2, y2 = lmList[12][1:]
-        print(x1, y1, x2, y2)
-
-        # 3. Check which fingers are up
-        fingers = detector.fingersUp()
-        print(fingers)
-        cv2.rectangle(img, (frameR, frameR), (wCam - frameR, hCam - frameR),
-                      (255, 0, 255), 2)
-
-        # 4. Only Index Finger : Move Mode
-        if fingers[1] == 1 and fingers[2] == 0:
-            # 5. Convert Coordinates
-            x3 = np.interp(x1, (frameR, wCam - frameR), (0, wScr))
-            y3 = np.interp(y1, (frameR, hCam - frameR), (0, hScr))
-
-            # 6. Smoothen Values
-            clocX = plocX + (x3 - plocX) / smoothening
-            clocY = plocY + (y3 - plocY) / smoothening
-
-            # 7. Move Mouse
-            pyautogui.moveTo(wScr - clocX, clocY)
-            cv2.circle(img, (x1, y1), 15, (255, 0, 255), cv2.FILLED)
-            plocX, plocY = clocX, clocY
-
-        # 8. Both middle and index fingers are up : Clicking Mode
-        if fingers[1] == 1 and fingers[2] == 1:
-
-            # 9. Find distance between fingers
-            length, img, lineInfo = detector.findDistance(8, 12, img)
-            print(length)
-
-            # 10. Click mouse if distance is short
-            if length < 50:
-                cv2.circle(img, (lineInfo[4], lineInfo[5]),
+pyautogui.PAUSE = 0  # no built-in sleep after every call
+
+# Mode lookup for all 32 packed finger codes (bit 1 = index, bit 2 = middle)
+moveMode = tuple(code & 0b00110 == 0b00010 for code in range(32))
+clickMode = tuple(code & 0b00110 == 0b00110 for code in range(32))
+
+# Mouse events are injected from a worker thread so that pyautogui
+# never stalls the capture loop. A pending move is replaced by a newer
+# one, clicks are always delivered in order.
+mouseEvents = deque()
+mouseCond = threading.Condition()
+mouseStopped = threading.Event()  # set when the worker died, e.g. fail-safe
+
+
+def mouseWorker():
+    while True:
+        with mouseCond:
+            while not mouseEvents:
+                mouseCond.wait()
+            event, x, y = mouseEvents.popleft()
+        try:
+            if event == "move":
+                pyautogui.moveTo(x, y)
+            else:
+                pyautogui.click()
+        except Exception as e:  # pyautogui.FailSafeException in a corner
+            print(f"mouse control stopped: {e!r}")
+            mouseStopped.set()
+            return
+
+
+def sendMouse(event, x=0, y=0):
+    with mouseCond:
+        if event == "move" and mouseEvents and mouseEvents[-1][0] == "move":
+            mouseEvents[-1] = (event, x, y)  # only the newest position matters
+        else:
+            mouseEvents.append((event, x, y))
+        mouseCond.notify()
+
+
+def drawBorder(img, x1, y1, x2, y2, color, t=2):
+    # Hollow rectangle as four slice writes instead of cv2.rectangle
+    img[y1:y1 + t, x1:x2 + 1] = color
+    img[y2 - t + 1:y2 + 1, x1:x2 + 1] = color
+    img[y1:y2 + 1, x1:x1 + t] = color
+    img[y1:y2 + 1, x2 - t + 1:x2 + 1] = color
+
+
+def main():
+    fps = htm.fpsCounter()
+    fpsText = None
+    frameCount = 0
+    skippedDraws = 0
+    idleFrames = 0
+    lastClick = -clickDelay
+    plocX, plocY = 0, 0
+    clocX, clocY = 0, 0
+    fpsMask = np.zeros((60, 160), bool)  # pre-rendered FPS text pixels
+
+    threading.Thread(target=mouseWorker, daemon=True).start()
+
+    cap = htm.frameGrabber(0, wCam, hCam)
+    detector = htm.handDetector(maxHands=1, modelComplexity=0)
+    wScr, hScr = pyautogui.size()
+    frameBudget = 1000 / cap.fps if cap.fps > 0 else 0  # ms per camera frame
+
+    # Camera -> screen scale factors for the reduced frame, using the size
+    # the camera actually delivers rather than the wCam x hCam request
+    camW, camH = cap.width, cap.height
+    scaleX = wScr / float(camW - 2 * frameR)
+    scaleY = hScr / float(camH - 2 * frameR)
+
+    # Hot functions bound as locals for the frame loop
+    now = time.perf_counter  # monotonic, unaffected by clock changes
+    putText = cv2.putText
+    circle = cv2.circle
+    imshow = cv2.imshow
+    waitKey = cv2.waitKey
+
+    while not mouseStopped.is_set():
+        loopStart = now()
+        # 1. Find hand Landmarks
+        success, img = cap.read()
+        if not success:
+            break
+        cTime = now()
+        # Falling behind the camera: leave out the landmark overlays
+        draw = cap.dropped <= 1
+        skippedDraws += not draw
+        img = detector.findHands(img, draw)
+        lmList, bbox = detector.findPosition(img, draw=draw)
+
+        # 2. Find the tips of the index and middle fingers
+        idleFrames = 0 if len(lmList) else idleFrames + 1
+        if len(lmList) != 0:
+            x1, y1 = lmList[8].tolist()
+            x2, y2 = lmList[12].tolist()
+            print(x1, y1, x2, y2)
+
+            # 3. Check which fingers are up
+            code = detector.fingerCode()
+            print(f"{code:05b}")  # pinky .. thumb
+            drawBorder(img, frameR, frameR, camW - frameR, camH - frameR,
+                       (255, 0, 255))
+
+            # 4. Only Index Finger : Move Mode
+            if moveMode[code]:
+                # 5. Convert Coordinates
+                x3 = min(max((x1 - frameR) * scaleX, 0), wScr)
+                y3 = min(max((y1 - frameR) * scaleY, 0), hScr)
+
+                # 6. Smoothen Values
+                clocX = plocX + (x3 - plocX) / smoothening
+                clocY = plocY + (y3 - plocY) / smoothening
+
+                # 7. Move Mouse
+                sendMouse("move", wScr - clocX, clocY)
+                circle(img, (x1, y1), 15, (255, 0, 255), cv2.FILLED)
+                plocX, plocY = clocX, clocY
+
+            # 8. Both middle and index fingers are up : Clicking Mode
+            if clickMode[code]:
+
+                # 9. Find distance between fingers
+                length, img, lineInfo = detector.findDistance(8, 12, img)
+                print(length)
+
+                # 10. Click mouse if distance is short
+                if length < 50:
+                    circle(img, (lineInfo[4], lineInfo[5]),
                            15, (0, 255, 0), cv2.FILLED)
-            pyautogui.click()
+                    if cTime - lastClick > clickDelay:
+                        sendMouse("click")
+                        lastClick = cTime
 
         # 11. Frame rate
-    cTime = time.time()
-    fps = 1 / (cTime - pTime)
-    pTime = cTime
-    cv2.putText(img, str(int(fps)), (20, 50), cv2.FONT_HERSHEY_PLAIN, 3,
-                (255, 0, 0), 3)
-
-    # 12. Display
-    cv2.imshow("Image", img)
-    cv2.waitKey(1)
+        fps.update()
+        if frameCount % fpsRefresh == 0 and fps.text != fpsText:
+            fpsText = fps.text
+            textImg = np.zeros(fpsMask.shape, np.uint8)
+            putText(textImg, fpsText, (20, 50), cv2.FONT_HERSHEY_PLAIN,
+                    3, 255, 3)
+            fpsMask = textImg > 0
+        frameCount += 1
+        img[:fpsMask.shape[0], :fpsMask.shape[1]][fpsMask] = (255, 0, 0)
+
+        # 12. Display
+        imshow("Image", img)
+        # Sleep out the rest of the camera frame instead of spinning, and
+        # poll at a lower rate while no hand has been seen for a while
+        if idleFrames > idleAfter:
+            waitMs = idleWait
+        else:
+            waitMs = max(1, int(frameBudget - (now() - loopStart) * 1000))
+        key = waitKey(waitMs) & 0xFF
+        if key == ord('d'):
+            print(f"frames dropped: {cap.droppedTotal}, "
+                  f"overlays skipped: {skippedDraws}/{frameCount}")
+
+
+if __name__ == "__main__":
+    main()
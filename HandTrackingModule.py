@@ -1,127 +1,468 @@
 import math
+import os
+import sys
 import time
+import threading
+from collections import deque
 import cv2
+import numpy as np
 import mediapipe as mp
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, the kernels then run as plain Python
+    def njit(*args, **kwargs):
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
 
-class handDetector:
-    mpHands = mp.solutions.hands
-    hands = mpHands.Hands()
-    mpDraw = mp.solutions.drawing_utils
-    tiplds = [4, 8, 12, 16, 20]
+# Landmark index pairs of the hand skeleton, as one array for cv2.polylines
+handConnections = np.array(sorted(mp.solutions.hands.HAND_CONNECTIONS),
+                           dtype=np.int32)
+
+
+def noDisplay():
+    # True when there is no screen to show a window on
+    if sys.platform.startswith("linux"):
+        return not (os.environ.get("DISPLAY") or os.environ.get("WAYLAND_DISPLAY"))
+    return False
+
+
+def landmarkArray(handLms):
+    # Normalised (x, y) of every landmark as an (n, 2) array, read straight
+    # from the protobuf without building per-landmark tuples
+    n = len(handLms.landmark)
+    return np.fromiter((v for lm in handLms.landmark for v in (lm.x, lm.y)),
+                       dtype=np.float64, count=2 * n).reshape(n, 2)
+
+
+def packFingers(fingers):
+    # fingersUp() result as one int, bit i set when finger i (thumb = 0) is up
+    code = 0
+    for i, f in enumerate(fingers):
+        code |= f << i
+    return code
+
+
+@njit(cache=True, nogil=True, fastmath=True)
+def classifyHandshape(lm, out):
+    # Fills out[:11] from the (21, 2) landmark array:
+    #   out[0:5]  1 where the finger is up (thumb first), as fingersUp
+    #   out[5:10] curl of each finger in radians, the bend between the
+    #             knuckle->middle-joint and middle-joint->tip segments
+    #   out[10]   orientation, angle of the wrist->middle-knuckle vector
+    out[0] = 1.0 if lm[4, 0] > lm[3, 0] else 0.0
+    for i in range(1, 5):
+        tip = 4 * i + 4
+        out[i] = 1.0 if lm[tip, 1] < lm[tip - 2, 1] else 0.0
+
+    for i in range(5):
+        tip = 4 * i + 4
+        ax = lm[tip - 2, 0] - lm[tip - 3, 0]
+        ay = lm[tip - 2, 1] - lm[tip - 3, 1]
+        bx = lm[tip, 0] - lm[tip - 2, 0]
+        by = lm[tip, 1] - lm[tip - 2, 1]
+        out[5 + i] = abs(math.atan2(ax * by - ay * bx, ax * bx + ay * by))
+
+    out[10] = math.atan2(lm[9, 1] - lm[0, 1], lm[9, 0] - lm[0, 0])
 
-    def __init__(self):
-        self.lmList = None
-        self.results = None
 
-    def __int__(self, mode=False, maxHands=2, detectionCon=1, trackCon=1):
+class handDetector:
+    def __init__(self, mode=False, maxHands=2, detectionCon=0.5, trackCon=0.5,
+                 modelComplexity=1, inferSide=320, motionThresh=3.0, maxSkip=5,
+                 useOpenCL=False, headless=False, overlay=False):
         self.mode = mode
         self.maxHands = maxHands
         self.trackCon = trackCon
         self.detectionCon = detectionCon
+        self.modelComplexity = modelComplexity  # 0 = lite landmark model
+        self.inferSide = inferSide  # max short side fed to MediaPipe, None = full frame
+        self.inferScale = 1.0  # scale of the last detection image
+        self.motionThresh = motionThresh  # mean grey-level change, 0 = always detect
+        self.maxSkip = maxSkip  # max frames in a row that reuse old landmarks
+        # Pre-processing on the GPU through OpenCV's transparent API
+        self.useOpenCL = useOpenCL and cv2.ocl.haveOpenCL()
+        self.headless = headless  # never draw, whatever draw= says
+        # Draw into a separate layer that composite() blends in once per frame
+        self.useOverlay = overlay
+        self.overlay = None
 
         self.mpHands = mp.solutions.hands
-        self.hands = self.mpHands.Hands(self.mode, self.maxHands, self.detectionCon, self.trackCon)
-        self.mpDraw = mp.solutions.drawing_utils
-        self.tiplds = [4, 8, 12, 16, 20]
+        self.hands = self.mpHands.Hands(static_image_mode=self.mode,
+                                        max_num_hands=self.maxHands,
+                                        model_complexity=self.modelComplexity,
+                                        min_detection_confidence=self.detectionCon,
+                                        min_tracking_confidence=self.trackCon)
+        self.tiplds = np.array([4, 8, 12, 16, 20], dtype=np.intp)
+        # Landmark pixel coordinates as separate contiguous x and y arrays
+        self.xs = np.empty(0, dtype=np.int32)
+        self.ys = np.empty(0, dtype=np.int32)
+        self.lmCache = None
+        self.results = None
+        self.prevGray = None
+        self.skipped = 0
+        self.smallBuf = None  # reused downscaled frame for detection
+        self.rgbBuf = None  # reused RGB copy of the frame sent to MediaPipe
+        self.handshape = np.zeros(11, dtype=np.float32)  # see classifyHandshape
+        self.lastPoseKey = None  # landmark bytes at the last classification
+        self.fingers = np.zeros(5, dtype=np.int8)  # flags of the last classified pose
+        self.lastCode = 0
+
+        # Compile the handshape kernel now rather than on the first hand
+        classifyHandshape(np.zeros((21, 2), dtype=np.int32), self.handshape)
 
     def findHands(self, img, draw=True):
-        imgRGB = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        self.results = self.hands.process(imgRGB)
+        draw = draw and not self.headless
+        if self.useOverlay and self.overlay is not None:
+            self.overlay.fill(0)  # new frame, drop last frame's drawing
+        canvas = self.canvas(img)
+        # Landmarks come back normalised, so detecting on a smaller copy
+        # still lines up with the full-size frame used for drawing
+        src = cv2.UMat(img) if self.useOpenCL else img
+        h, w, c = img.shape
+        self.inferScale = min(1.0, self.inferSide / min(h, w)) if self.inferSide else 1.0
+        if self.inferScale < 1:
+            size = (round(w * self.inferScale), round(h * self.inferScale))
+            if self.useOpenCL:
+                small = cv2.resize(src, size, interpolation=cv2.INTER_AREA)
+            else:
+                if self.smallBuf is None or self.smallBuf.shape[1::-1] != size:
+                    self.smallBuf = np.empty((size[1], size[0], c), dtype=np.uint8)
+                small = cv2.resize(src, size, dst=self.smallBuf,
+                                   interpolation=cv2.INTER_AREA)
+        else:
+            small = src
+
+        # Reuse the last landmarks while the scene has barely changed since
+        # the last frame MediaPipe saw
+        gray = cv2.cvtColor(cv2.resize(small, (32, 24), interpolation=cv2.INTER_AREA),
+                            cv2.COLOR_BGR2GRAY)
+        if (self.results is not None and self.skipped < self.maxSkip
+                and cv2.mean(cv2.absdiff(gray, self.prevGray))[0] < self.motionThresh):
+            self.skipped += 1
+        else:
+            if self.useOpenCL:
+                # MediaPipe needs a numpy array
+                imgRGB = cv2.cvtColor(small, cv2.COLOR_BGR2RGB).get()
+            else:
+                if self.rgbBuf is None or self.rgbBuf.shape != small.shape:
+                    self.rgbBuf = np.empty(small.shape, dtype=np.uint8)
+                imgRGB = cv2.cvtColor(small, cv2.COLOR_BGR2RGB, dst=self.rgbBuf)
+            self.results = self.hands.process(imgRGB)
+            self.prevGray = gray
+            self.skipped = 0
         # print(results.multi_hand_landmarks)
 
         if self.results.multi_hand_landmarks:
             for handLms in self.results.multi_hand_landmarks:
                 if draw:
-                    self.mpDraw.draw_landmarks(img, handLms,
-                                               self.mpHands.HAND_CONNECTIONS)
+                    pts = (landmarkArray(handLms) * (w, h)).astype(np.int32)
+                    cv2.polylines(canvas, list(pts[handConnections]), False,
+                                  (224, 224, 224), 2)
+                    for cx, cy in pts.tolist():
+                        cv2.circle(canvas, (cx, cy), 2, (0, 0, 255), cv2.FILLED)
 
         return img
 
     def findPosition(self, img, handNo=0, draw=True):
-        xList = []
-        yList = []
+        draw = draw and not self.headless
+        canvas = self.canvas(img)
         bbox = []
-        self.lmList = []
+        self.xs = self.ys = np.empty(0, dtype=np.int32)
+        self.lmCache = None
         if self.results.multi_hand_landmarks:
             myHand = self.results.multi_hand_landmarks[handNo]
-            for id, lm in enumerate(myHand.landmark):
-                # print(id, lm)
-                h, w, c = img.shape
-                cx, cy = int(lm.x * w), int(lm.y * h)
-                xList.append(cx)
-                yList.append(cy)
-                # print(id, cx, cy)
-                self.lmList.append([id, cx, cy])
-                if draw:
-                    cv2.circle(img, (cx, cy), 5, (255, 0, 255), cv2.FILLED)
+            h, w, c = img.shape
+            pts = landmarkArray(myHand)
+            self.xs = (pts[:, 0] * w).astype(np.int32)
+            self.ys = (pts[:, 1] * h).astype(np.int32)
+            if draw:
+                for cx, cy in zip(self.xs.tolist(), self.ys.tolist()):
+                    cv2.circle(canvas, (cx, cy), 5, (255, 0, 255), cv2.FILLED)
 
-            xmin, xmax = min(xList), max(xList)
-            ymin, ymax = min(yList), max(yList)
+            xmin, xmax = int(self.xs.min()), int(self.xs.max())
+            ymin, ymax = int(self.ys.min()), int(self.ys.max())
             bbox = xmin, ymin, xmax, ymax
 
             if draw:
-                cv2.rectangle(img, (xmin - 20, ymin - 20), (xmax + 20, ymax + 20),
+                cv2.rectangle(canvas, (xmin - 20, ymin - 20), (xmax + 20, ymax + 20),
                               (0, 255, 0), 2)
 
         return self.lmList, bbox
 
+    def canvas(self, img):
+        # Where to draw for img: img itself, or the overlay layer, which is
+        # (re)allocated here when it is missing or sized for another frame
+        if not self.useOverlay:
+            return img
+        if self.overlay is None or self.overlay.shape != img.shape:
+            self.overlay = np.zeros_like(img)
+        return self.overlay
+
+    @property
+    def lmList(self):
+        # (21, 2) [x, y] rows, the row index is the landmark id. Built from
+        # xs/ys on first use after each findPosition.
+        if self.lmCache is None:
+            self.lmCache = np.column_stack((self.xs, self.ys))
+        return self.lmCache
+
+    def fingertips(self):
+        # (5, 2) [x, y] of the thumb..pinky tips in one gather
+        return self.lmList[self.tiplds]
+
+    def fingerCode(self):
+        # fingersUp() as one packFingers int, without building a list.
+        # Unchanged landmarks (e.g. a frame the motion gate reused) keep
+        # the last answer.
+        if self.lmList.size == 0:  # no hand: the kernel must not index it
+            self.lastPoseKey = None
+            self.fingers[:] = 0
+            self.lastCode = 0
+            return 0
+        key = self.lmList.tobytes()
+        if key != self.lastPoseKey:
+            classifyHandshape(self.lmList, self.handshape)
+            self.lastPoseKey = key
+            self.fingers[:] = self.handshape[:5]
+            self.lastCode = packFingers(self.fingers.tolist())
+        return self.lastCode
+
     def fingersUp(self):
-        fingers = []
-        # Thumb
-        if self.lmList[self.tiplds[0]][1] > self.lmList[self.tiplds[0] - 1][1]:
-            fingers.append(1)
+        self.fingerCode()
+        return self.fingers.tolist()
+
+    def findDistance(self, p1, p2, img, draw=True, r=15, t=3):
+        lengths, img, lineInfo = self.findDistances([[p1, p2]], img, draw, r, t)
+        return float(lengths[0]), img, lineInfo[0].tolist()
+
+    def findDistances(self, pairs, img, draw=True, r=15, t=3):
+        # pairs is an (N, 2) sequence of landmark ids. Returns the N lengths
+        # and an (N, 6) array of [x1, y1, x2, y2, cx, cy] rows.
+        pairs = np.asarray(pairs)
+        x, y = self.xs[pairs], self.ys[pairs]  # (N, 2) each
+        lengths = np.hypot(x[:, 1] - x[:, 0], y[:, 1] - y[:, 0])
+        # Midpoints stay in int32, the shift is a floor halving like // 2
+        lineInfo = np.column_stack((x[:, 0], y[:, 0], x[:, 1], y[:, 1],
+                                    (x[:, 0] + x[:, 1]) >> 1,
+                                    (y[:, 0] + y[:, 1]) >> 1))
+
+        if draw and not self.headless:
+            canvas = self.canvas(img)
+            for x1, y1, x2, y2, cx, cy in lineInfo.tolist():
+                cv2.line(canvas, (x1, y1), (x2, y2), (255, 0, 255), t)
+                cv2.circle(canvas, (x1, y1), r, (255, 0, 255), cv2.FILLED)
+                cv2.circle(canvas, (x2, y2), r, (255, 0, 255), cv2.FILLED)
+                cv2.circle(canvas, (cx, cy), r, (0, 0, 255), cv2.FILLED)
+
+        return lengths, img, lineInfo
+
+    def composite(self, img, alpha=1.0):
+        # Blend the overlay layer onto img in place, once after all drawing
+        if self.useOverlay and self.overlay is not None:
+            cv2.addWeighted(img, 1.0, self.overlay, alpha, 0.0, dst=img)
+        return img
+
+
+# Single-slot handoff between threads: put() overwrites whatever is waiting,
+# get() blocks until there is an item newer than the last one taken
+class latestSlot:
+    def __init__(self):
+        self.item = None
+        self.pending = 0  # items overwritten since the last get()
+        self.dropped = 0  # items missed before the last get()
+        self.droppedTotal = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        with self.cond:
+            if self.item is not None:
+                self.pending += 1
+            self.item = item
+            self.cond.notify()
+
+    def get(self):
+        # Returns None once the slot is closed and drained
+        with self.cond:
+            while self.item is None and not self.closed:
+                self.cond.wait()
+            item, self.item = self.item, None
+            self.dropped, self.pending = self.pending, 0
+            self.droppedTotal += self.dropped
+        return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+# Reads the camera on a background thread and keeps only the newest frame,
+# so hand tracking always works on the most recent image
+class frameGrabber:
+    # threaded=False reads on the caller's thread instead; frames that piled
+    # up in the driver since the last read are grabbed without decoding
+    maxDrain = 3  # most frames grabbed per read when the buffer size is unknown
+
+    def __init__(self, src=0, width=640, height=480, fps=60, threaded=True):
+        if sys.platform.startswith("win"):
+            backend = cv2.CAP_DSHOW
+        elif sys.platform.startswith("linux"):
+            backend = cv2.CAP_V4L2
         else:
-            fingers.append(0)
+            backend = cv2.CAP_ANY
+        self.cap = cv2.VideoCapture(src, backend)
+        # MJPG must be requested before the size for some drivers to honour it
+        self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*'MJPG'))
+        self.cap.set(3, width)
+        self.cap.set(4, height)
+        self.cap.set(cv2.CAP_PROP_FPS, fps)
+        self.cap.set(cv2.CAP_PROP_BUFFERSIZE, 1)
+        # What the camera actually agreed to
+        self.fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.width = int(self.cap.get(3))
+        self.height = int(self.cap.get(4))
+        fourcc = int(self.cap.get(cv2.CAP_PROP_FOURCC))
+        # Backends without the property report 0 or -1
+        self.fourcc = (fourcc.to_bytes(4, "little").decode("ascii", "replace")
+                       if fourcc > 0 else "")
+        if self.fourcc != "MJPG":
+            print(f"camera is using {self.fourcc!r} instead of MJPG")
+        # Backends that ignore the property report 0 or -1
+        bufferSize = int(self.cap.get(cv2.CAP_PROP_BUFFERSIZE))
+        self.drainLimit = bufferSize if bufferSize > 0 else self.maxDrain
+        self.slot = latestSlot()
+        self.running = True
+        self.thread = None
+        self.lastRead = None
+        self.drained = 0
+        self.drainedTotal = 0
+        if threaded:
+            self.thread = threading.Thread(target=self.update, daemon=True)
+            self.thread.start()
 
-        # Fingers
-        for id in range(1, 5):
+    @property
+    def dropped(self):
+        return self.slot.dropped if self.thread else self.drained
 
-            if self.lmList[self.tiplds[id]][2] < self.lmList[self.tiplds[id] - 2][2]:
-                fingers.append(1)
-            else:
-                fingers.append(0)
+    @property
+    def droppedTotal(self):
+        return self.slot.droppedTotal if self.thread else self.drainedTotal
 
-        # totalFingers = fingers.count(1)
+    def update(self):
+        while self.running:
+            # cap.read() returns a fresh array, so a frame handed to the
+            # consumer is never written again
+            success, frame = self.cap.read()
+            if not success:
+                break
+            self.slot.put(frame)
+        self.slot.close()
 
-        return fingers
+    def read(self):
+        if self.thread is None:
+            return self.drainRead()
+        frame = self.slot.get()
+        return frame is not None, frame
 
-    def findDistance(self, p1, p2, img, draw=True, r=15, t=3):
-        x1, y1 = self.lmList[p1][1:]
-        x2, y2 = self.lmList[p2][1:]
-        cx, cy = (x1 + x2) // 2, (y1 + y2) // 2
+    def drainRead(self):
+        # Frames due since the last read are stale: grab() them (no decode)
+        # and retrieve() only the newest. Never grab more than the driver
+        # buffers, and stop as soon as a grab() had to wait for the camera,
+        # since that frame is already the freshest one.
+        n = 1
+        if self.lastRead is not None and self.fps > 0:
+            n = min(max(1, int((time.perf_counter() - self.lastRead) * self.fps)),
+                    self.drainLimit)
+        success = self.cap.grab()
+        grabs = 1
+        while success and grabs < n:
+            t = time.perf_counter()
+            success = self.cap.grab()
+            grabs += 1
+            if time.perf_counter() - t > 0.5 / self.fps:
+                break
+        frame = None
+        if success:
+            success, frame = self.cap.retrieve()
+        self.lastRead = time.perf_counter()
+        self.drained = grabs - 1
+        self.drainedTotal += grabs - 1
+        return success, frame
+
+    def release(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.cap.release()
 
-        if draw:
-            cv2.line(img, (x1, y1), (x2, y2), (255, 0, 255), t)
-            cv2.circle(img, (x1, y1), r, (255, 0, 255), cv2.FILLED)
-            cv2.circle(img, (x2, y2), r, (255, 0, 255), cv2.FILLED)
-            cv2.circle(img, (cx, cy), r, (0, 0, 255), cv2.FILLED)
-        length = math.hypot(x2 - x1, y2 - y1)
 
-        return length, img, [x1, y1, x2, y2, cx, cy]
+# Frame rate over the last n frames from a ring of perf_counter timestamps.
+# text is only re-formatted when the whole-number rate changes.
+class fpsCounter:
+    def __init__(self, n=30):
+        self.stamps = deque(maxlen=n)
+        self.fps = 0.0
+        self.fpsInt = 0
+        self.text = "0"
+
+    def update(self):
+        self.stamps.append(time.perf_counter())
+        if len(self.stamps) > 1:
+            self.fps = (len(self.stamps) - 1) / (self.stamps[-1] - self.stamps[0])
+            if int(self.fps) != self.fpsInt:
+                self.fpsInt = int(self.fps)
+                self.text = str(self.fpsInt)
+        return self.fps
 
 
 def main():
-    pTime = 0
-    cTime = 0
-    cap = cv2.VideoCapture(0)
-    detector = handDetector()
+    fps = fpsCounter()
+    headless = noDisplay()
+    cap = frameGrabber(0)
+    detector = handDetector(headless=headless)
+    results = latestSlot()
+    stop = threading.Event()
+
+    # Camera -> inference -> display, each stage on its own thread
+    def inference():
+        while not stop.is_set():
+            success, img = cap.read()
+            if not success:
+                break
+            img = detector.findHands(img)
+            lmList, bbox = detector.findPosition(img)
+            results.put((img, lmList))
+        results.close()
+
+    worker = threading.Thread(target=inference, daemon=True)
+    worker.start()
+
     while True:
-        success, img = cap.read()
-        img = detector.findHands(img)
-        lmList, bbox = detector.findPosition(img)
+        out = results.get()
+        if out is None:
+            break
+        img, lmList = out
         if len(lmList) != 0:
             print(lmList[4])
 
-        cTime = time.time()
-        fps = 1 / (cTime - pTime)
-        pTime = cTime
-
-        cv2.putText(img, str(int(fps)), (10, 70), cv2.FONT_HERSHEY_PLAIN, 3,
+        fps.update()
+        if headless:
+            continue
+        cv2.putText(img, fps.text, (10, 70), cv2.FONT_HERSHEY_PLAIN, 3,
                     (255, 0, 255), 3)
+        # Camera frames inference never saw because it was still busy
+        cv2.putText(img, f"skipped {cap.droppedTotal}", (10, 100),
+                    cv2.FONT_HERSHEY_PLAIN, 1.5, (255, 0, 255), 2)
 
         cv2.imshow("Image", img)
-        cv2.waitKey(1)
+        if cv2.waitKey(1) & 0xFF == ord('q'):
+            break
+
+    stop.set()
+    cap.release()
+    worker.join()
 
 
 if __name__ == "__main__":